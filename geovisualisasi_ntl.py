@@ -7,13 +7,188 @@ FOKUS PADA VISUALISASI GEOSPASIAL NTL
 import streamlit as st
 import numpy as np
 import rasterio
-import matplotlib.pyplot as plt
+from rasterio.enums import Resampling
+from rasterio.errors import RasterioError
+from matplotlib.figure import Figure
 import tempfile
 import os
+import io
+import time
+import atexit
+import threading
+import weakref
+import base64
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import folium
+from folium import plugins
 from streamlit_folium import st_folium
 import pandas as pd
 from matplotlib.colors import LinearSegmentedColormap
+from PIL import Image
+
+# ----------------------------
+# KONFIGURASI GDAL
+# ----------------------------
+
+# GDAL membaca opsi ini dari environment saat raster pertama dibaca (bukan saat import),
+# nilai yang sudah diset di environment tetap diutamakan
+os.environ.setdefault("GDAL_CACHEMAX", "512")  # MB, block cache untuk rerun Streamlit
+os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS")
+# File unggahan disimpan sebagai satu TIFF dengan nama berbasis hash, sehingga sidecar
+# .ovr/.aux.xml tidak pernah ada di sampingnya; listing direktori unggahan bisa dilewati
+os.environ.setdefault("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+
+# ----------------------------
+# FUNGSI PEMBACAAN DATA RASTER
+# ----------------------------
+
+# Ukuran chunk saat menyalin file unggahan ke disk
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Ukuran maksimum (pixel) sisi terpanjang raster untuk keperluan tampilan
+DISPLAY_MAX_SIZE = 1200
+
+# Jumlah bin histogram Single View
+HISTOGRAM_BINS = 50
+
+# Jumlah sampel pixel per raster untuk estimasi persentil skala warna bersama
+ROBUST_RANGE_SAMPLE_SIZE = 100_000
+
+# File unggahan (dan hasil cache-nya) yang tidak dipakai selama ini akan dihapus, dalam detik
+UPLOAD_MAX_AGE = 6 * 60 * 60
+
+class _UploadSessionToken:
+    """Penanda sesi Streamlit; hilang bersama st.session_state ketika sesi berakhir"""
+
+@st.cache_resource
+def get_upload_dir():
+    """Direktori penyimpanan file unggahan yang bertahan antar rerun Streamlit"""
+    # Setelah cache di-clear direktori baru dibuat; direktori lama tetap dihapus saat exit
+    upload_dir = tempfile.mkdtemp(prefix="ntl_upload_")
+    atexit.register(shutil.rmtree, upload_dir, ignore_errors=True)
+    return upload_dir
+
+@st.cache_resource
+def get_upload_references():
+    """Registry proses: path file unggahan -> WeakSet token sesi yang memakainya"""
+    return threading.Lock(), {}
+
+def register_upload_reference(file_path):
+    """Catat bahwa sesi ini memakai file_path, agar tidak dihapus selama sesi masih hidup"""
+    token = st.session_state.setdefault('upload_session_token', _UploadSessionToken())
+    lock, references = get_upload_references()
+    with lock:
+        references.setdefault(file_path, weakref.WeakSet()).add(token)
+
+def prune_upload_dir(upload_dir, max_age=UPLOAD_MAX_AGE):
+    """Hapus file unggahan yang tidak direferensikan sesi mana pun dan lebih tua dari max_age detik"""
+    lock, references = get_upload_references()
+    with lock:
+        for path in [path for path, sessions in references.items() if not sessions]:
+            del references[path]
+        in_use = set(references)
+    
+    cutoff = time.time() - max_age
+    with os.scandir(upload_dir) as entries:
+        for entry in entries:
+            if entry.path in in_use:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Sudah dihapus oleh sesi lain
+
+def get_upload_digest(uploaded_file):
+    """Hash isi file unggahan, dihitung sekali per file_id dan disimpan di st.session_state"""
+    digests = st.session_state.setdefault('upload_digests', {})
+    if uploaded_file.file_id not in digests:
+        # getbuffer() berupa memoryview (tanpa salinan), dilepas setelah hashing
+        with uploaded_file.getbuffer() as buffer:
+            digests[uploaded_file.file_id] = hashlib.blake2b(buffer, digest_size=16).hexdigest()
+    return digests[uploaded_file.file_id]
+
+def save_uploaded_raster(uploaded_file):
+    """Simpan file unggahan dengan nama berbasis hash isi file"""
+    file_hash = get_upload_digest(uploaded_file)
+    upload_dir = get_upload_dir()
+    file_path = os.path.join(upload_dir, f"{file_hash}_{uploaded_file.name}")
+    
+    # Selama sesi ini hidup (termasuk saat idle), file tidak ikut dihapus prune_upload_dir
+    register_upload_reference(file_path)
+    
+    # File dengan isi yang sama cukup ditulis sekali; mtime diperbarui sebagai tanda
+    # terakhir dipakai. File yang sudah terhapus ditulis ulang dari unggahan sesi ini.
+    try:
+        os.utime(file_path)
+        return file_path
+    except FileNotFoundError:
+        pass
+    
+    prune_upload_dir(upload_dir)
+    
+    # Salin per chunk 8 MB ke file sementara lalu rename atomik, sehingga sesi lain
+    # tidak membuka TIFF setengah jadi dan salinan yang terputus tidak tertinggal
+    uploaded_file.seek(0)
+    tmp_file = tempfile.NamedTemporaryFile("wb", dir=upload_dir, suffix=".part", delete=False)
+    try:
+        with tmp_file:
+            shutil.copyfileobj(uploaded_file, tmp_file, length=UPLOAD_CHUNK_SIZE)
+        os.replace(tmp_file.name, file_path)
+    except BaseException:
+        os.remove(tmp_file.name)
+        raise
+    return file_path
+
+def _read_ntl_raster(raster_path, max_size=None):
+    """Baca band pertama raster NTL sebagai float32 (nodata = NaN), didecimasi ke max_size"""
+    with rasterio.open(raster_path) as src:
+        scale = max(src.height, src.width) / max_size if max_size else 1
+        if scale > 1:
+            out_shape = (max(1, int(src.height / scale)), max(1, int(src.width / scale)))
+            data = src.read(1, out_shape=out_shape, resampling=Resampling.average,
+                            out_dtype=np.float32)
+        else:
+            data = src.read(1, out_dtype=np.float32)
+        data[data == src.nodata] = np.nan
+        return data, src.bounds
+
+@st.cache_data(show_spinner=False, max_entries=32, ttl=UPLOAD_MAX_AGE)
+def load_ntl_raster(raster_path, max_size=None):
+    """Baca raster NTL dengan cache antar rerun (path berisi hash isi file)"""
+    return _read_ntl_raster(raster_path, max_size)
+
+def map_rasters(func, rasters):
+    """Jalankan func untuk setiap raster (path atau array) secara paralel di thread pool"""
+    # Worker tidak memiliki ScriptRunContext Streamlit, jadi func harus fungsi biasa
+    # (bukan st.cache_*); lookup cache dilakukan pemanggil di thread script
+    max_workers = max(1, min(len(rasters), os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, rasters))
+
+def _read_display_raster(raster_path):
+    """Baca raster resolusi tampilan; error rasterio dikembalikan agar bisa ditampilkan per subplot"""
+    try:
+        return _read_ntl_raster(raster_path, DISPLAY_MAX_SIZE)
+    except RasterioError as e:
+        return e
+
+@st.cache_data(show_spinner=False, max_entries=8, ttl=UPLOAD_MAX_AGE)
+def load_display_rasters(raster_paths):
+    """Baca semua raster resolusi tampilan secara paralel (di-cache per kombinasi raster)"""
+    # Error tidak ditangkap di sini agar kegagalan (termasuk yang sementara) tidak ikut di-cache
+    return map_rasters(lambda raster_path: _read_ntl_raster(raster_path, DISPLAY_MAX_SIZE),
+                       raster_paths)
+
+def read_display_rasters(raster_paths):
+    """Seperti load_display_rasters, tetapi raster yang gagal dibaca dikembalikan sebagai exception"""
+    try:
+        return load_display_rasters(raster_paths)
+    except RasterioError:
+        # Ada raster yang gagal: baca ulang per raster tanpa cache
+        return map_rasters(_read_display_raster, raster_paths)
 
 # ----------------------------
 # FUNGSI VISUALISASI GEOSPASIAL
@@ -24,99 +199,206 @@ def create_ntl_colormap():
     colors = ['black', 'darkblue', 'blue', 'cyan', 'yellow', 'white']
     return LinearSegmentedColormap.from_list('ntl_colormap', colors, N=256)
 
+@st.cache_resource
+def get_ntl_colormap():
+    """Colormap NTL dan lookup table RGBA uint8 (256 x 4), dibuat sekali per proses"""
+    # streamlit run mengeksekusi ulang modul ini setiap rerun, jadi global tingkat modul
+    # akan dibangun ulang pada setiap interaksi widget
+    cmap = create_ntl_colormap()
+    return cmap, (cmap(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+
+def get_value_range(data):
+    """Hitung (min, max) data NTL dengan mengabaikan NaN"""
+    data_min = np.min(data)
+    if np.isnan(data_min):
+        return np.fmin.reduce(data, axis=None), np.fmax.reduce(data, axis=None)
+    return data_min, np.max(data)
+
+def get_robust_value_range(arrays, percentiles=(1, 99)):
+    """Hitung rentang nilai bersama (persentil) dari beberapa array NTL, NaN diabaikan"""
+    # Persentil diestimasi dari sampel berjarak tetap per array, tanpa menyalin semua pixel
+    samples = []
+    for data in arrays:
+        flat = data.ravel()
+        sample = flat[::max(1, flat.size // ROBUST_RANGE_SAMPLE_SIZE)]
+        samples.append(sample[np.isfinite(sample)])
+    values = np.concatenate(samples) if samples else np.empty(0, dtype=np.float32)
+    if values.size > 0:
+        low, high = np.percentile(values, percentiles)
+        if high > low:
+            return float(low), float(high)
+    
+    # Sampel tanpa pixel valid (raster jarang/di luar swath) atau p1 == p99 pada scene yang
+    # didominasi radiansi nol: pakai min/max penuh
+    ranges = [r for r in map(get_value_range, arrays) if not np.isnan(r[0])]
+    if not ranges:
+        return 0.0, 0.0
+    return float(min(r[0] for r in ranges)), float(max(r[1] for r in ranges))
+
+def normalize_ntl_data(data, scale=1.0, value_range=None):
+    """Normalisasi data NTL ke rentang 0-scale secara in-place (opsional dengan value_range bersama)"""
+    data_min, data_max = value_range if value_range is not None else get_value_range(data)
+    data_range = data_max - data_min
+    
+    np.subtract(data, data_min, out=data)
+    if data_range > 0:
+        np.divide(data, data_range / scale, out=data)
+    return data
+
+def encode_png_data_uri(rgba):
+    """Encode array RGBA uint8 menjadi PNG data URI tanpa file sementara"""
+    buffer = io.BytesIO()
+    # compress_level=1: encode jauh lebih cepat, ukuran sedikit lebih besar
+    Image.fromarray(rgba).save(buffer, format='PNG', optimize=False, compress_level=1)
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def render_overlay_png(data, lut, value_range=None):
+    """Warnai array NTL dengan lut dan encode sebagai PNG data URI (nodata transparan, in-place)"""
+    # Catat pixel nodata sebelum normalisasi agar bisa dibuat transparan
+    nodata_mask = np.isnan(data)
+    
+    # Normalisasi langsung ke rentang indeks LUT 0-255, nilai di luar value_range
+    # dipotong ke ujung skala dan nodata menjadi 0
+    data_norm = normalize_ntl_data(data, scale=255, value_range=value_range)
+    np.clip(data_norm, 0, 255, out=data_norm)
+    data_norm[nodata_mask] = 0
+    
+    rgba = lut[data_norm.astype(np.uint8)]
+    rgba[nodata_mask, 3] = 0
+    return encode_png_data_uri(rgba)
+
+def get_session_figure(slot, nrows=1, ncols=1, **kwargs):
+    """Ambil (fig, axes, created) dari st.session_state, figure dibuat hanya jika belum ada"""
+    if slot in st.session_state:
+        fig, axes = st.session_state[slot]
+        return fig, axes, False
+    
+    # Figure dibuat tanpa pyplot agar tidak terdaftar di registry global pyplot dan
+    # ikut dibebaskan bersama st.session_state ketika sesi berakhir
+    fig = Figure(**kwargs)
+    axes = fig.subplots(nrows, ncols)
+    st.session_state[slot] = (fig, axes)
+    return fig, axes, True
+
 def plot_geospatial_ntl(raster_path, title="Nighttime Lights"):
     """Visualisasi geospasial raster NTL dengan Matplotlib"""
     try:
-        with rasterio.open(raster_path) as src:
-            data = src.read(1)
-            bounds = src.bounds
-            
-            # Handle no data values
-            data[data == src.nodata] = np.nan
-            
-            fig, ax = plt.subplots(1, 1, figsize=(10, 8))
-            
-            # Plot raster dengan colormap khusus NTL
-            ntl_cmap = create_ntl_colormap()
-            im = ax.imshow(data, cmap=ntl_cmap, 
-                          extent=[bounds.left, bounds.right, bounds.bottom, bounds.top])
-            
+        # Handle no data values (sudah ditangani oleh loader)
+        data, bounds = load_ntl_raster(raster_path, DISPLAY_MAX_SIZE)
+        extent = [bounds.left, bounds.right, bounds.bottom, bounds.top]
+        
+        fig, ax, created = get_session_figure('ntl_single_fig', figsize=(10, 8))
+        
+        if not created:
+            # Figure dari rerun sebelumnya: cukup perbarui data dan skala warna
+            im = ax.images[0]
+            im.set_data(data)
+            im.set_extent(extent)
+            im.set_clim(*get_value_range(data))
             ax.set_title(title, fontsize=14, fontweight='bold')
-            ax.set_xlabel('Longitude')
-            ax.set_ylabel('Latitude')
-            
-            # Add colorbar
-            cbar = plt.colorbar(im, ax=ax, shrink=0.6)
-            cbar.set_label('Radiance (nW/cm²/sr)')
-            
-            # Add grid
-            ax.grid(True, alpha=0.3)
-            
-            plt.tight_layout()
             return fig
+        
+        # Plot raster dengan colormap khusus NTL
+        # Data sudah seukuran layar, interpolasi nearest cukup
+        cmap, _ = get_ntl_colormap()
+        im = ax.imshow(data, cmap=cmap, extent=extent, interpolation='nearest')
+        
+        ax.set_title(title, fontsize=14, fontweight='bold')
+        ax.set_xlabel('Longitude')
+        ax.set_ylabel('Latitude')
+        
+        # Add colorbar (fraction/pad tetap, tanpa pencarian ukuran lewat shrink)
+        cbar = fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+        cbar.set_label('Radiance (nW/cm²/sr)')
+        
+        # Add grid
+        ax.grid(True, alpha=0.3)
+        
+        # Layout cukup dihitung sekali; rerun berikutnya memakai figure yang sama
+        fig.tight_layout()
+        return fig
             
     except Exception as e:
         st.error(f"Error dalam visualisasi raster: {str(e)}")
         return None
 
-def create_interactive_ntl_map(raster_paths, year_labels=None):
+@st.cache_data(show_spinner="Membangun peta interaktif...", max_entries=8, ttl=UPLOAD_MAX_AGE)
+def render_map_overlays(raster_paths):
+    """Render PNG overlay semua raster dengan skala warna bersama, list (image_uri, bounds)"""
+    # Array hasil load_display_rasters adalah salinan dari cache, aman dinormalisasi in-place
+    display_rasters = load_display_rasters(raster_paths)
+    
+    # Raster yang seluruhnya nodata dilewati tanpa normalisasi maupun encode PNG
+    value_ranges = [get_value_range(data) for data, _ in display_rasters]
+    overlay_indices = [i for i, (vmin, _) in enumerate(value_ranges) if not np.isnan(vmin)]
+    
+    # Skala warna bersama untuk semua tahun agar overlay dapat dibandingkan; persentil 1-99
+    # agar satu pixel flare/outlier tidak menggelapkan overlay semua tahun
+    value_range = get_robust_value_range([display_rasters[i][0] for i in overlay_indices])
+    
+    # Encode PNG semua overlay secara paralel langsung dari array yang sudah dibaca
+    image_uris = [None] * len(display_rasters)
+    # LUT diambil di thread script, worker tidak boleh memanggil st.cache_*
+    _, lut = get_ntl_colormap()
+    encoded = map_rasters(lambda i: render_overlay_png(display_rasters[i][0], lut, value_range),
+                          overlay_indices)
+    for i, image_uri in zip(overlay_indices, encoded):
+        image_uris[i] = image_uri
+    return [(image_uri, bounds) for image_uri, (_, bounds) in zip(image_uris, display_rasters)]
+
+def build_ntl_map(raster_paths, year_labels=None, opacity=0.7):
+    """Bangun objek peta Folium baru untuk data NTL dari overlay yang sudah di-cache"""
+    # Map dibuat baru per pemanggilan (objek mutable, tidak dibagi antar sesi); bagian
+    # mahalnya, baca raster dan encode PNG, diambil dari cache render_map_overlays
+    overlays = render_map_overlays(raster_paths)
+    
+    # Gunakan raster pertama untuk center map
+    _, bounds = overlays[0]
+    center_lat = (bounds.top + bounds.bottom) / 2
+    center_lon = (bounds.left + bounds.right) / 2
+    
+    # Buat peta dasar
+    m = folium.Map(location=[center_lat, center_lon], 
+                  zoom_start=8, 
+                  tiles='CartoDB dark_matter')
+    
+    # Tambahkan tile layers alternatif
+    folium.TileLayer('OpenStreetMap').add_to(m)
+    folium.TileLayer('CartoDB positron').add_to(m)
+    
+    # Untuk setiap raster, tambahkan sebagai overlay (raster tanpa data valid dilewati)
+    for i, (image_uri, bounds) in enumerate(overlays):
+        if image_uri is None:
+            continue
+        year_label = year_labels[i] if year_labels and i < len(year_labels) else f"Year {i+1}"
+        
+        # Add raster overlay ke peta
+        img_overlay = folium.raster_layers.ImageOverlay(
+            name=year_label,
+            image=image_uri,
+            bounds=[[bounds.bottom, bounds.left], [bounds.top, bounds.right]],
+            opacity=opacity,
+            interactive=True,
+            cross_origin=False
+        ).add_to(m)
+    
+    # Tambahkan layer control
+    folium.LayerControl().add_to(m)
+    
+    # Tambahkan measure control
+    plugins.MeasureControl(position='bottomleft').add_to(m)
+    
+    # Tambahkan fullscreen control
+    plugins.Fullscreen(position='topright').add_to(m)
+    
+    return m
+
+def create_interactive_ntl_map(raster_paths, year_labels=None, opacity=0.7):
     """Membuat peta interaktif dengan Folium untuk data NTL"""
     try:
         if not raster_paths:
             return None
-            
-        # Gunakan raster pertama untuk center map
-        with rasterio.open(raster_paths[0]) as src:
-            bounds = src.bounds
-            center_lat = (bounds.top + bounds.bottom) / 2
-            center_lon = (bounds.left + bounds.right) / 2
-        
-        # Buat peta dasar
-        m = folium.Map(location=[center_lat, center_lon], 
-                      zoom_start=8, 
-                      tiles='CartoDB dark_matter')
-        
-        # Tambahkan tile layers alternatif
-        folium.TileLayer('OpenStreetMap').add_to(m)
-        folium.TileLayer('CartoDB positron').add_to(m)
-        
-        # Untuk setiap raster, tambahkan sebagai overlay
-        for i, raster_path in enumerate(raster_paths):
-            with rasterio.open(raster_path) as src:
-                bounds = src.bounds
-                year_label = year_labels[i] if year_labels and i < len(year_labels) else f"Year {i+1}"
-                
-                # Convert raster to PNG untuk overlay
-                data = src.read(1)
-                data[data == src.nodata] = 0
-                
-                # Normalisasi data untuk visualisasi
-                data_norm = (data - np.nanmin(data)) / (np.nanmax(data) - np.nanmin(data))
-                
-                # Simpan sebagai PNG sementara
-                with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_file:
-                    plt.imsave(tmp_file.name, data_norm, cmap=create_ntl_colormap())
-                    
-                    # Add raster overlay ke peta
-                    img_overlay = folium.raster_layers.ImageOverlay(
-                        name=year_label,
-                        image=tmp_file.name,
-                        bounds=[[bounds.bottom, bounds.left], [bounds.top, bounds.right]],
-                        opacity=0.7,
-                        interactive=True,
-                        cross_origin=False
-                    ).add_to(m)
-        
-        # Tambahkan layer control
-        folium.LayerControl().add_to(m)
-        
-        # Tambahkan measure control
-        folium.plugins.MeasureControl(position='bottomleft').add_to(m)
-        
-        # Tambahkan fullscreen control
-        folium.plugins.Fullscreen(position='topright').add_to(m)
-        
-        return m
+        return build_ntl_map(raster_paths, year_labels, opacity)
         
     except Exception as e:
         st.error(f"Error membuat peta interaktif: {str(e)}")
@@ -128,63 +410,185 @@ def plot_ntl_comparison(raster_paths, titles=None):
     n_cols = min(3, n_rasters)
     n_rows = (n_rasters + n_cols - 1) // n_cols
     
-    fig, axes = plt.subplots(n_rows, n_cols, figsize=(5*n_cols, 4*n_rows))
+    # Figure dipakai ulang per ukuran grid; rerun cukup memperbarui data tiap AxesImage
+    slot = f'ntl_comparison_fig_{n_rows}x{n_cols}'
+    fig, axes, created = get_session_figure(slot, n_rows, n_cols, figsize=(5*n_cols, 4*n_rows))
+    axes = np.asarray(axes).reshape(n_rows, n_cols)
+    
+    # Baca semua raster secara paralel, rendering matplotlib tetap di thread utama
+    loaded_rasters = read_display_rasters(raster_paths)
     
-    if n_rasters == 1:
-        axes = np.array([axes])
-    if n_rows == 1:
-        axes = axes.reshape(1, -1)
+    # Skala warna bersama (persentil 1-99, sama dengan overlay peta) agar antar dataset
+    # dapat dibandingkan langsung
+    valid_arrays = [loaded[0] for loaded in loaded_rasters if not isinstance(loaded, Exception)]
+    vmin, vmax = get_robust_value_range(valid_arrays)
+    cmap, _ = get_ntl_colormap()
     
-    for i, (ax, raster_path) in enumerate(zip(axes.flat, raster_paths)):
+    im = None
+    for i, (ax, loaded) in enumerate(zip(axes.flat, loaded_rasters)):
+        ax.set_visible(True)
         try:
-            with rasterio.open(raster_path) as src:
-                data = src.read(1)
-                data[data == src.nodata] = np.nan
-                bounds = src.bounds
-                
-                ntl_cmap = create_ntl_colormap()
-                im = ax.imshow(data, cmap=ntl_cmap,
-                              extent=[bounds.left, bounds.right, bounds.bottom, bounds.top])
-                
-                title = titles[i] if titles and i < len(titles) else f"NTL {i+1}"
-                ax.set_title(title, fontsize=12)
+            if isinstance(loaded, Exception):
+                raise loaded
+            data, bounds = loaded
+            extent = [bounds.left, bounds.right, bounds.bottom, bounds.top]
+            
+            if ax.images:
+                im = ax.images[0]
+                im.set_data(data)
+                im.set_extent(extent)
+                im.set_clim(vmin, vmax)
+            else:
+                # Axes baru atau sebelumnya berisi pesan error
+                ax.cla()
+                im = ax.imshow(data, cmap=cmap, vmin=vmin, vmax=vmax, interpolation='nearest',
+                              extent=extent)
                 ax.set_xlabel('Longitude')
                 ax.set_ylabel('Latitude')
                 ax.grid(True, alpha=0.3)
-                
-                # Add colorbar untuk setiap subplot
-                plt.colorbar(im, ax=ax, shrink=0.8)
-                
+            
+            title = titles[i] if titles and i < len(titles) else f"NTL {i+1}"
+            ax.set_title(title, fontsize=12)
+            
         except Exception as e:
+            ax.cla()
             ax.text(0.5, 0.5, f"Error\n{str(e)}", 
                    ha='center', va='center', transform=ax.transAxes)
             ax.set_title("Error Loading Data")
     
     # Sembunyikan axes yang tidak terpakai
-    for j in range(i+1, n_rows*n_cols):
+    for j in range(n_rasters, n_rows*n_cols):
         axes.flat[j].set_visible(False)
     
-    plt.tight_layout()
+    if created:
+        fig.tight_layout()
+    
+    # Satu colorbar untuk semua subplot (skala sudah sama), disimpan bersama figure.
+    # Setiap rerun colorbar diarahkan ke image yang tampil, bukan image lama di axes
+    # yang kini tersembunyi atau sudah dibersihkan karena error.
+    cbar_slot = f'{slot}_colorbar'
+    cbar = st.session_state.get(cbar_slot)
+    if im is None:
+        # Semua raster gagal: colorbar cukup disembunyikan. Colorbar.remove() tidak bisa
+        # dipakai karena ax.cla() sudah melepas mappable-nya dari axes
+        if cbar is not None:
+            cbar.ax.set_visible(False)
+    elif cbar is None:
+        st.session_state[cbar_slot] = fig.colorbar(im, ax=axes.ravel().tolist(), shrink=0.8)
+    else:
+        cbar.ax.set_visible(True)
+        cbar.update_normal(im)
     return fig
 
+def _valid_block_values(block, nodata):
+    """Ambil pixel valid (finite, bukan nodata) dari satu blok raster sebagai array 1D"""
+    if block.dtype.kind == 'f':
+        # NaN dan +-inf ikut tersaring agar statistik dan rentang histogram tetap finite
+        valid = np.isfinite(block)
+        if nodata is not None:
+            np.logical_and(valid, np.not_equal(block, nodata), out=valid)
+        return block[valid]
+    if nodata is not None:
+        # Raster integer tidak mungkin berisi NaN, cukup cek nodata
+        return block[block != nodata]
+    return block.ravel()
+
+def _block_histogram(src, value_range):
+    """Histogram HISTOGRAM_BINS bin (counts, edges) seluruh raster, dibaca per blok"""
+    # Rentang dan bin sama untuk setiap blok, jadi jumlah counts per blok sama persis
+    # dengan np.histogram atas seluruh pixel valid
+    counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for _, window in src.block_windows(1):
+        values = _valid_block_values(src.read(1, window=window), src.nodata)
+        counts += np.histogram(values, bins=HISTOGRAM_BINS, range=value_range)[0]
+    edges = np.histogram_bin_edges(np.empty(0), bins=HISTOGRAM_BINS, range=value_range)
+    return counts, edges
+
+def _compute_raster_statistics(raster_path):
+    """Hitung statistik dan histogram raster NTL dengan pembacaan per blok"""
+    count, mean, m2 = 0, 0.0, 0.0
+    data_min, data_max = np.inf, -np.inf
+    
+    with rasterio.open(raster_path) as src:
+        for _, window in src.block_windows(1):
+            block = src.read(1, window=window)
+            values = _valid_block_values(block, src.nodata).astype(np.float64)
+            
+            n = values.size
+            if n == 0:
+                continue
+            
+            block_min, block_max = values.min(), values.max()
+            data_min = min(data_min, block_min)
+            data_max = max(data_max, block_max)
+            
+            # M2 blok dari simpangan terhadap mean blok (dua langkah), bukan sum(x^2) - n*mean^2
+            # yang kehilangan presisi pada blok bermean tinggi dan bervarians kecil.
+            # values adalah salinan float64, jadi boleh dikurangi in-place.
+            block_mean = values.sum() / n
+            np.subtract(values, block_mean, out=values)
+            block_m2 = np.dot(values, values)
+            
+            # Gabungkan statistik blok ke akumulator
+            delta = block_mean - mean
+            total = count + n
+            mean += delta * n / total
+            m2 += block_m2 + delta ** 2 * count * n / total
+            count = total
+        
+        if count == 0:
+            return {'Min': np.nan, 'Max': np.nan, 'Mean': np.nan, 'Std': np.nan, 'Area (px)': 0}, None
+        
+        # Rentang Min-Max baru diketahui setelah pass pertama; pass kedua menghitung
+        # histogram resolusi penuh yang persis sama dengan np.histogram
+        histogram = _block_histogram(src, (data_min, data_max))
+    
+    stats = {
+        'Min': data_min,
+        'Max': data_max,
+        'Mean': mean,
+        'Std': np.sqrt(m2 / count),
+        'Area (px)': count
+    }
+    return stats, histogram
+
+@st.cache_resource
+def get_statistics_handoff():
+    """Registry proses: path raster -> hasil statistik dari pool, None jika sudah masuk cache"""
+    return threading.Lock(), {}
+
+@st.cache_data(show_spinner=False, max_entries=64, ttl=UPLOAD_MAX_AGE)
+def compute_raster_statistics(raster_path):
+    """Statistik dan histogram (counts, edges) satu raster dengan cache antar rerun"""
+    # Hasil yang baru dihitung generate_ntl_statistics di thread pool diambil dari registry
+    lock, handoff = get_statistics_handoff()
+    with lock:
+        result = handoff.get(raster_path)
+        handoff[raster_path] = None
+    return result if result is not None else _compute_raster_statistics(raster_path)
+
 def generate_ntl_statistics(raster_paths):
-    """Generate statistics untuk data NTL"""
+    """Generate statistics untuk data NTL dari cache statistik per raster"""
+    # Raster yang belum pernah dihitung diproses paralel; lookup cache tetap di thread script.
+    # Entri yang sudah kedaluwarsa dari cache dihitung ulang oleh compute_raster_statistics.
+    lock, handoff = get_statistics_handoff()
+    with lock:
+        missing = [path for path in dict.fromkeys(raster_paths) if path not in handoff]
+    computed = map_rasters(_compute_raster_statistics, missing)
+    with lock:
+        handoff.update(zip(missing, computed))
+    
     stats_data = []
     
-    for i, path in enumerate(raster_paths):
-        with rasterio.open(path) as src:
-            data = src.read(1)
-            data[data == src.nodata] = np.nan
-            
-            stats = {
-                'Dataset': f"NTL {i+1}",
-                'Min': np.nanmin(data),
-                'Max': np.nanmax(data),
-                'Mean': np.nanmean(data),
-                'Std': np.nanstd(data),
-                'Area (px)': np.sum(~np.isnan(data))
-            }
-            stats_data.append(stats)
+    for i, raster_path in enumerate(raster_paths):
+        raster_stats, _ = compute_raster_statistics(raster_path)
+        stats = {'Dataset': f"NTL {i+1}"}
+        stats.update(raster_stats)
+        stats_data.append(stats)
+    
+    # Hasil yang tidak terpakai karena cache per raster ternyata sudah berisi dilepas
+    with lock:
+        handoff.update(dict.fromkeys(missing))
     
     return pd.DataFrame(stats_data)
 
@@ -208,115 +612,114 @@ def setup_geospatial_visualization():
     )
     
     if raster_files:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            raster_paths = []
-            for i, uploaded_file in enumerate(raster_files):
-                file_path = os.path.join(tmpdir, uploaded_file.name)
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                raster_paths.append(file_path)
+        raster_paths = [save_uploaded_raster(uploaded_file) for uploaded_file in raster_files]
+        
+        st.success(f"✅ {len(raster_paths)} file raster berhasil diunggah")
+        
+        # Kontrol visualisasi
+        col1, col2 = st.columns(2)
+        with col1:
+            viz_type = st.selectbox(
+                "Tipe Visualisasi",
+                ["Peta Interaktif", "Grid Comparison", "Analisis Statistik", "Single View"]
+            )
+        with col2:
+            opacity = st.slider("Opacity Peta", 0.1, 1.0, 0.7)
+        
+        # Visualisasi berdasarkan pilihan
+        if viz_type == "Peta Interaktif":
+            st.subheader("🗺️ Peta Interaktif Nighttime Lights")
+            years = [f"Tahun {2020+i}" for i in range(len(raster_paths))]
+            interactive_map = create_interactive_ntl_map(raster_paths, years, opacity)
+            if interactive_map:
+                st_folium(interactive_map, width=900, height=600)
+            else:
+                st.error("Gagal membuat peta interaktif")
+        
+        elif viz_type == "Grid Comparison":
+            st.subheader("📊 Perbandingan Multi-Temporal")
+            titles = [f"Data {i+1} ({uploaded_file.name})" for i, uploaded_file in enumerate(raster_files)]
+            comp_fig = plot_ntl_comparison(raster_paths, titles)
+            st.pyplot(comp_fig)
+        
+        elif viz_type == "Analisis Statistik":
+            st.subheader("📈 Statistik Spasial NTL")
             
-            st.success(f"✅ {len(raster_paths)} file raster berhasil diunggah")
+            stats_df = generate_ntl_statistics(raster_paths)
+            st.dataframe(stats_df.style.format({
+                'Min': '{:.2f}',
+                'Max': '{:.2f}', 
+                'Mean': '{:.2f}',
+                'Std': '{:.2f}'
+            }), use_container_width=True)
             
-            # Kontrol visualisasi
-            col1, col2 = st.columns(2)
-            with col1:
-                viz_type = st.selectbox(
-                    "Tipe Visualisasi",
-                    ["Peta Interaktif", "Grid Comparison", "Analisis Statistik", "Single View"]
-                )
-            with col2:
-                opacity = st.slider("Opacity Peta", 0.1, 1.0, 0.7)
+            # Visualisasi trend
+            if len(raster_paths) > 1:
+                fig, axes, created = get_session_figure('ntl_trend_fig', 2, 2, figsize=(12, 8))
+                
+                # Data preparation (pakai ulang statistik yang sudah dihitung)
+                metrics = {
+                    'Mean Radiance': stats_df['Mean'].tolist(),
+                    'Max Radiance': stats_df['Max'].tolist(),
+                    'Illuminated Area': stats_df['Area (px)'].tolist(),
+                    'Std Dev': stats_df['Std'].tolist()
+                }
+                
+                for idx, (title, values) in enumerate(metrics.items()):
+                    ax = axes[idx//2, idx%2]
+                    ax.cla()
+                    x_range = list(range(len(values)))
+                    ax.plot(x_range, values, 'o-', linewidth=2, markersize=6)
+                    ax.set_title(title)
+                    ax.set_xlabel('Dataset')
+                    ax.set_ylabel('Nilai')
+                    ax.grid(True, alpha=0.3)
+                    ax.set_xticks(x_range)
+                    ax.set_xticklabels([f'DS{i+1}' for i in x_range])
+                
+                if created:
+                    fig.tight_layout()
+                st.pyplot(fig)
+        
+        elif viz_type == "Single View":
+            st.subheader("🔍 Detail Visualisasi per Dataset")
             
-            # Visualisasi berdasarkan pilihan
-            if viz_type == "Peta Interaktif":
-                st.subheader("🗺️ Peta Interaktif Nighttime Lights")
-                years = [f"Tahun {2020+i}" for i in range(len(raster_paths))]
-                interactive_map = create_interactive_ntl_map(raster_paths, years)
-                if interactive_map:
-                    st_folium(interactive_map, width=900, height=600)
-                else:
-                    st.error("Gagal membuat peta interaktif")
+            selected_idx = st.selectbox(
+                "Pilih dataset",
+                options=list(range(len(raster_files))),
+                format_func=lambda x: f"Dataset {x+1} - {raster_files[x].name}"
+            )
             
-            elif viz_type == "Grid Comparison":
-                st.subheader("📊 Perbandingan Multi-Temporal")
-                titles = [f"Data {i+1} ({uploaded_file.name})" for i, uploaded_file in enumerate(raster_files)]
-                comp_fig = plot_ntl_comparison(raster_paths, titles)
-                st.pyplot(comp_fig)
+            col1, col2 = st.columns([2, 1])
             
-            elif viz_type == "Analisis Statistik":
-                st.subheader("📈 Statistik Spasial NTL")
-                
-                stats_df = generate_ntl_statistics(raster_paths)
-                st.dataframe(stats_df.style.format({
-                    'Min': '{:.2f}',
-                    'Max': '{:.2f}', 
-                    'Mean': '{:.2f}',
-                    'Std': '{:.2f}'
-                }), use_container_width=True)
-                
-                # Visualisasi trend
-                if len(raster_paths) > 1:
-                    fig, axes = plt.subplots(2, 2, figsize=(12, 8))
-                    
-                    # Data preparation
-                    metrics = {
-                        'Mean Radiance': [np.nanmean(rasterio.open(path).read(1)) for path in raster_paths],
-                        'Max Radiance': [np.nanmax(rasterio.open(path).read(1)) for path in raster_paths],
-                        'Illuminated Area': [np.sum(~np.isnan(rasterio.open(path).read(1))) for path in raster_paths],
-                        'Std Dev': [np.nanstd(rasterio.open(path).read(1)) for path in raster_paths]
-                    }
-                    
-                    for idx, (title, values) in enumerate(metrics.items()):
-                        ax = axes[idx//2, idx%2]
-                        x_range = list(range(len(values)))
-                        ax.plot(x_range, values, 'o-', linewidth=2, markersize=6)
-                        ax.set_title(title)
-                        ax.set_xlabel('Dataset')
-                        ax.set_ylabel('Nilai')
-                        ax.grid(True, alpha=0.3)
-                        ax.set_xticks(x_range)
-                        ax.set_xticklabels([f'DS{i+1}' for i in x_range])
-                    
-                    plt.tight_layout()
+            with col1:
+                fig = plot_geospatial_ntl(raster_paths[selected_idx], 
+                                         f"Nighttime Lights - {raster_files[selected_idx].name}")
+                if fig:
                     st.pyplot(fig)
             
-            elif viz_type == "Single View":
-                st.subheader("🔍 Detail Visualisasi per Dataset")
-                
-                selected_idx = st.selectbox(
-                    "Pilih dataset",
-                    options=list(range(len(raster_files))),
-                    format_func=lambda x: f"Dataset {x+1} - {raster_files[x].name}"
-                )
-                
-                col1, col2 = st.columns([2, 1])
+            with col2:
+                # Statistik dataset terpilih
+                # Entri cache per raster yang sama dengan tab Analisis Statistik
+                stats, histogram = compute_raster_statistics(raster_paths[selected_idx])
                 
-                with col1:
-                    fig = plot_geospatial_ntl(raster_paths[selected_idx], 
-                                            f"Nighttime Lights - {raster_files[selected_idx].name}")
-                    if fig:
-                        st.pyplot(fig)
+                st.metric("Radiansi Minimum", f"{stats['Min']:.2f}")
+                st.metric("Radiansi Maksimum", f"{stats['Max']:.2f}")
+                st.metric("Radiansi Rata-rata", f"{stats['Mean']:.2f}")
+                st.metric("Area Terang (pixels)", f"{stats['Area (px)']:,}")
                 
-                with col2:
-                    # Statistik dataset terpilih
-                    with rasterio.open(raster_paths[selected_idx]) as src:
-                        data = src.read(1)
-                        data[data == src.nodata] = np.nan
-                        
-                        st.metric("Radiansi Minimum", f"{np.nanmin(data):.2f}")
-                        st.metric("Radiansi Maksimum", f"{np.nanmax(data):.2f}")
-                        st.metric("Radiansi Rata-rata", f"{np.nanmean(data):.2f}")
-                        st.metric("Area Terang (pixels)", f"{np.sum(~np.isnan(data)):,}")
-                        
-                        # Histogram
-                        fig_hist, ax_hist = plt.subplots(figsize=(6, 4))
-                        ax_hist.hist(data[~np.isnan(data)].flatten(), bins=50, alpha=0.7, edgecolor='black')
-                        ax_hist.set_xlabel('Radiansi')
-                        ax_hist.set_ylabel('Frekuensi')
-                        ax_hist.set_title('Distribusi Radiansi')
-                        ax_hist.grid(True, alpha=0.3)
-                        st.pyplot(fig_hist)
+                # Histogram resolusi penuh agar konsisten dengan metrik di atas
+                if histogram is not None:
+                    counts, edges = histogram
+                    fig_hist, ax_hist, _ = get_session_figure('ntl_hist_fig', figsize=(6, 4))
+                    ax_hist.cla()
+                    ax_hist.bar(edges[:-1], counts, width=np.diff(edges), align='edge',
+                                alpha=0.7, edgecolor='black')
+                    ax_hist.set_xlabel('Radiansi')
+                    ax_hist.set_ylabel('Frekuensi')
+                    ax_hist.set_title('Distribusi Radiansi')
+                    ax_hist.grid(True, alpha=0.3)
+                    st.pyplot(fig_hist)
     else:
         st.info("📁 Silakan unggah file TIFF raster NTL untuk memulai visualisasi")
 